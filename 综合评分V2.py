@@ -1,16 +1,531 @@
+import asyncio
+import functools
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
 import pandas as pd
 import numpy as np
-import akshare as ak
 import requests
-import json
 from datetime import datetime , timedelta
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.preprocessing import StandardScaler
 import warnings
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor , as_completed
 
 warnings.filterwarnings('ignore')
 
+# 接口数据缓存目录
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)) , '.cache')
+
+
+def disk_cache(ttl_hours = 8):
+    """
+    接口数据缓存装饰器
+    按 (函数名, 参数, 当天日期) 把结果存到硬盘，超过 ttl_hours 小时重新下载；
+    同一次运行内再用内存去重，多线程同时请求同一份数据时只下载一次
+    被装饰的函数另有 lookup(*args) 只查缓存、返回 (是否命中, 数据)，
+    store(data, *args) 把别处取到的数据存入缓存
+    缓存文件名以函数名开头；每天第一次用到时删除该函数超过 ttl_hours 的旧文件，并清空内存里前一天的数据
+    """
+
+    def decorator(func):
+        memory = {}
+        locks = {}
+        current_day = None
+        day_lock = threading.Lock( )
+
+        def purge( ):
+            """删除本函数过期的缓存文件，键里带着日期，旧文件不会再被读到"""
+            if not os.path.isdir(CACHE_DIR):
+                return
+            deadline = time.time( ) - ttl_hours * 3600
+            for name in os.listdir(CACHE_DIR):
+                if name.startswith(func.__name__ + '-') and name.endswith('.pkl'):
+                    path = os.path.join(CACHE_DIR , name)
+                    try:
+                        if os.path.getmtime(path) < deadline:
+                            os.remove(path)
+                    except OSError:
+                        pass  # 其他进程已删除
+
+        def make_key(args):
+            nonlocal current_day
+            today = datetime.now( ).strftime('%Y%m%d')
+            if today != current_day:
+                with day_lock:
+                    if today != current_day:
+                        memory.clear( )
+                        locks.clear( )
+                        purge( )
+                        current_day = today
+            return func.__name__ + '-' + hashlib.md5((func.__name__ + repr(args) + today).encode( )).hexdigest( )
+
+        def load(key):
+            if key in memory:
+                return True , memory[ key ]
+
+            path = os.path.join(CACHE_DIR , key + '.pkl')
+            if os.path.exists(path) and time.time( ) - os.path.getmtime(path) < ttl_hours * 3600:
+                with open(path , 'rb') as f:
+                    memory[ key ] = pickle.load(f)
+                return True , memory[ key ]
+            return False , None
+
+        def save(key , data):
+            # 先写临时文件再替换，避免中途出错留下半个文件
+            path = os.path.join(CACHE_DIR , key + '.pkl')
+            os.makedirs(CACHE_DIR , exist_ok = True)
+            tmp_path = f'{path}.{os.getpid( )}.{threading.get_ident( )}.tmp'
+            with open(tmp_path , 'wb') as f:
+                pickle.dump(data , f)
+            os.replace(tmp_path , path)
+            memory[ key ] = data
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = make_key(args)
+            with locks.setdefault(key , threading.Lock( )):
+                hit , data = load(key)
+                if not hit:
+                    data = func(*args)
+                    save(key , data)
+                return data
+
+        def lookup(*args):
+            return load(make_key(args))
+
+        def store(data , *args):
+            key = make_key(args)
+            with locks.setdefault(key , threading.Lock( )):
+                save(key , data)
+
+        wrapper.lookup = lookup
+        wrapper.store = store
+        return wrapper
+
+    return decorator
+
+
+# 本次运行中确认拿不到数据的请求 (函数名, 参数)，之后直接跳过
+FAILED_REQUESTS = set( )
+
+
+def retry_or_skip(attempts = 2):
+    """
+    接口请求出错处理装饰器
+    网络错误（连接失败、超时等）和 ValueError / TypeError 可能是暂时的，最多请求 attempts 次；
+    后者常见于被限流时接口返回 {"data": null}，解析时出错，不能因此整次运行都跳过这只股票
+    KeyError / IndexError（代码不存在、字段缺失等）再请求也一样，记入 FAILED_REQUESTS，本次运行内不再请求
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (func.__name__ , args)
+            if key in FAILED_REQUESTS:
+                raise LookupError(f"{func.__name__}{args} 之前已失败，跳过")
+
+            for attempt in range(attempts):
+                try:
+                    return func(*args)
+                except (requests.RequestException , ValueError , TypeError):
+                    if attempt == attempts - 1:
+                        raise
+                except (KeyError , IndexError):
+                    FAILED_REQUESTS.add(key)
+                    raise
+
+        return wrapper
+
+    return decorator
+
+
+@functools.cache
+def _ak( ):
+    """第一次请求数据时才导入 akshare，它会连带导入很多模块，启动较慢"""
+    import akshare
+    return akshare
+
+
+@disk_cache(ttl_hours = 8)
+@retry_or_skip(attempts = 2)
+def _stock_individual_info_em(stock_code):
+    return _ak( ).stock_individual_info_em(symbol = stock_code)
+
+
+@disk_cache(ttl_hours = 8)
+@retry_or_skip(attempts = 2)
+def _stock_individual_fund_flow(stock_code):
+    return _ak( ).stock_individual_fund_flow(stock = stock_code , market = "主板")
+
+
+@disk_cache(ttl_hours = 8)
+@retry_or_skip(attempts = 2)
+def _stock_zh_a_hist(stock_code , start_date , end_date):
+    return _ak( ).stock_zh_a_hist(symbol = stock_code , period = "daily" , start_date = start_date , end_date = end_date)
+
+
+# 分段打分表：thresholds 升序排列，指标大于第 i 个阈值就进入更高一档，scores 比 thresholds 多一项
+Ladder = namedtuple('Ladder' , [ 'thresholds' , 'scores' ])
+
+
+def make_ladder_function(ladder):
+    """
+    根据分段表生成从高到低的 if value > 阈值 ... 打分函数，阈值和得分直接写成常数
+    value 先转成阈值的精度再比较，恰好等于阈值的指标落在较低一档，NaN 落在最低档
+    """
+    lines = [ 'def ladder(value):' , '    value = to_threshold_dtype(value)' ]
+    for threshold , score in zip(ladder.thresholds[ ::-1 ] , ladder.scores[ :0:-1 ]):
+        lines.append(f'    if value > {float(threshold)!r}:')
+        lines.append(f'        return {int(score)}')
+    lines.append(f'    return {int(ladder.scores[ 0 ])}')
+
+    namespace = {'to_threshold_dtype': ladder.thresholds.dtype.type}
+    exec('\n'.join(lines) , namespace)
+    return namespace[ 'ladder' ]
+
+
+def make_weighted_sum(weights):
+    """
+    根据权重生成加权求和函数，权重直接写成常数，参数名即维度名
+    用法：weighted_total(funding_score = 60, north_money_score = 70, ...)
+    """
+    params = ' , '.join(weights)
+    expression = ' + '.join(f'{dimension} * {float(weight)!r}' for dimension , weight in weights.items( ))
+
+    namespace = {}
+    exec(f'def weighted_total({params}):\n    return {expression}\n' , namespace)
+    return namespace[ 'weighted_total' ]
+
+
+def _block_sum(values , end , count):
+    """values[end - count:end] 依次相加，用 float64 累加"""
+    total = np.float64(0.0)
+    for i in range(end - count , end):
+        total += values[ i ]
+    return total
+
+
+def _technical_kernel(close , high , low):
+    """技术指标得分的计算部分：布林带位置、均线排列、简化SAR，只用到最后一天的指标"""
+    n = len(close)
+    latest_close = close[ n - 1 ]
+
+    # 每5天一块求和，再两两相加得到10日、20日之和；数据不足一个窗口时为 NaN
+    # 这样股价走平时三条均线严格相等，不会因为舍入误差误判成多头排列
+    ma5 = np.nan
+    ma10 = np.nan
+    ma20 = np.nan
+    if n >= 5:
+        sum5 = _block_sum(close , n , 5)
+        ma5 = sum5 / 5
+        if n >= 10:
+            sum10 = sum5 + _block_sum(close , n - 5 , 5)
+            ma10 = sum10 / 10
+            if n >= 20:
+                ma20 = (sum10 + (_block_sum(close , n - 10 , 5) + _block_sum(close , n - 15 , 5))) / 20
+
+    # 20日样本标准差，以最新收盘价为基准求偏差，股价走平时恰好为 0；用 float64 累加
+    std20 = np.nan
+    if n >= 20:
+        total = np.float64(0.0)
+        squares = np.float64(0.0)
+        for i in range(n - 20 , n):
+            diff = close[ i ] - latest_close
+            total += diff
+            squares += diff * diff
+        std20 = np.sqrt(max(squares - total * total / 20 , 0.0) / 19)
+
+    # 布林带位置得分
+    upper = ma20 + 2 * std20
+    lower = ma20 - 2 * std20
+    bb_position = (latest_close - lower) / (upper - lower) if (upper - lower) > 0 else 0.5
+
+    if bb_position > 0.7:
+        bb_score = 30  # 接近上轨，可能超买
+    elif bb_position > 0.3:
+        bb_score = 70  # 中轨附近
+    else:
+        bb_score = 40  # 接近下轨，可能超卖
+
+    # 均线排列得分
+    if ma5 > ma10 > ma20:
+        ma_score = 90
+    elif ma5 > ma10:
+        ma_score = 70
+    elif ma5 > ma20:
+        ma_score = 60
+    else:
+        ma_score = 40
+
+    # SAR指标（简化版）：最近5天的最高价和最低价
+    recent_high = high[ n - 1 ]
+    recent_low = low[ n - 1 ]
+    for i in range(max(n - 5 , 0) , n - 1):
+        recent_high = max(recent_high , high[ i ])
+        recent_low = min(recent_low , low[ i ])
+
+    if latest_close > recent_high:
+        sar_score = 80
+    elif latest_close < recent_low:
+        sar_score = 30
+    else:
+        sar_score = 60
+
+    return bb_score * 0.3 + ma_score * 0.4 + sar_score * 0.3
+
+
+_kernel_lock = threading.Lock( )
+_compiled_kernel = None
+
+
+def _get_technical_kernel( ):
+    """
+    第一次计算单只股票的技术指标时才导入 numba 并编译 _technical_kernel，导入 numba 本身要一百多毫秒
+    没有安装 numba 时返回普通 Python 函数，结果相同，只是慢一些
+    """
+    global _compiled_kernel , _block_sum
+    with _kernel_lock:
+        if _compiled_kernel is None:
+            try:
+                from numba import njit
+            except ImportError:
+                _compiled_kernel = _technical_kernel
+            else:
+                # numba 编译时按名字查找被调用的函数，先把 _block_sum 换成编译后的版本
+                _block_sum = njit(cache = True)(_block_sum)
+                _compiled_kernel = njit(cache = True)(_technical_kernel)
+        return _compiled_kernel
+
+
+@disk_cache(ttl_hours = 8)
+@retry_or_skip(attempts = 2)
+def _stock_hsgt_hold_panel( ):
+    return _ak( ).stock_hsgt_hold_stock_em(market = "北向" , indicator = "今日排行")
+
+
+@disk_cache(ttl_hours = 8)
+@retry_or_skip(attempts = 2)
+def _stock_margin_detail_sse(date):
+    return _ak( ).stock_margin_detail_sse(date = date)
+
+
+@disk_cache(ttl_hours = 8)
+@retry_or_skip(attempts = 2)
+def _stock_margin_detail_szse(date):
+    return _ak( ).stock_margin_detail_szse(date = date)
+
+
+def _latest_margin_balances(fetch_detail , code_column):
+    """
+    一个交易所最近两个交易日的融资余额，按股票代码索引，列为 融资余额、上一交易日融资余额；没有数据时返回 None
+    从今天往前逐日查找，当天的明细收盘后才发布，非交易日没有数据
+    """
+    balances = [ ]
+    day = datetime.now( )
+    for _ in range(15):
+        if day.weekday( ) < 5:
+            try:
+                detail = fetch_detail(day.strftime('%Y%m%d'))
+            except (LookupError , ValueError , TypeError):
+                detail = None  # 当天没有数据，网络错误照常抛出
+            if detail is not None and not detail.empty:
+                balances.append(detail.set_index(code_column)[ '融资余额' ])
+                if len(balances) == 2:
+                    break
+        day -= timedelta(days = 1)
+
+    if not balances:
+        return None
+    # 只找到一天的数据时，上一交易日余额取同一天，变化率为 0
+    return pd.DataFrame({'融资余额': balances[ 0 ] , '上一交易日融资余额': balances[ -1 ]})
+
+
+def _stock_margin_panel( ):
+    """沪深两市的融资余额明细，每只股票一行：标的证券代码、融资余额、上一交易日融资余额"""
+    panels = [ _latest_margin_balances(_stock_margin_detail_sse , '标的证券代码') ,
+               _latest_margin_balances(_stock_margin_detail_szse , '证券代码') ]
+    panels = [ panel for panel in panels if panel is not None ]
+    if not panels:
+        raise LookupError('最近没有融资融券明细数据')
+    return pd.concat(panels).rename_axis('标的证券代码').reset_index( )
+
+
+def load_panel(fetch , code_column):
+    """
+    获取全市场数据（每只股票一行）并按股票代码建索引，一次请求供所有股票使用
+    取不到时返回空表，各只股票该项记 50
+    """
+    try:
+        return fetch( ).set_index(code_column)
+    except Exception:
+        return pd.DataFrame( ).rename_axis(code_column)
+
+
+@disk_cache(ttl_hours = 8)
+def _hist_arrays(stock_code , start_date , end_date):
+    """
+    日线数据的 (收盘, 最高, 最低, 成交量) float64 数组，没有数据时为 None
+    不用 float32：两位小数的价格转成 float32 后，均线恰好相等、收益率恰好 10% 这类边界会判到另一档
+    异步预取的数据也存在这里，不写入 _stock_zh_a_hist，后者始终是 akshare 的原始结果
+    """
+    stock_data = _stock_zh_a_hist(stock_code , start_date , end_date)
+    if stock_data.empty:
+        return None
+
+    return tuple(stock_data[ column ].to_numpy(dtype = np.float64) for column in ('收盘' , '最高' , '最低' , '成交量'))
+
+
+@functools.lru_cache(maxsize = 256)
+def _hist(stock_code , start_date , end_date):
+    """
+    日线数组的内存缓存，键里带着日期，换一天自动失效
+    返回只读的 (收盘, 最高, 最低, 成交量) float64 数组，没有数据时返回 None
+    """
+    arrays = _hist_arrays(stock_code , start_date , end_date)
+    if arrays is None:
+        return None
+
+    for array in arrays:
+        array.flags.writeable = False
+    return arrays
+
+
+def _fetch_hist(stock_code , start_date , end_date):
+    """
+    获取 start_date 到 end_date（'%Y%m%d' 格式）的日线数据，只下载一次供各评分函数共用
+    返回 {'close', 'high', 'low', 'volume'} 四个 float64 数组，没有数据或请求失败时返回 None
+    """
+    try:
+        arrays = _hist(stock_code , start_date , end_date)
+    except Exception:
+        return None
+    if arrays is None:
+        return None
+
+    return dict(zip(('close' , 'high' , 'low' , 'volume') , arrays))
+
+
+def technical_scores_batch(hists):
+    """
+    一次算出多只股票的技术指标得分
+    hists 为 {股票代码: _fetch_hist 的结果}，返回 {股票代码: 得分}，没有数据的股票记 50
+    各股票最近20天的数据排成 (20, N) 矩阵，第 j 列是第 j 只股票，不足20天的在前面补 NaN；
+    沿第0维逐行累加，计算顺序与 _technical_kernel 相同，得分完全一致
+    """
+    codes = [ code for code , hist in hists.items( ) if hist is not None ]
+    scores = dict.fromkeys(hists , 50)
+    if not codes:
+        return scores
+
+    window = 20
+    close = np.full((window , len(codes)) , np.nan)
+    high = np.full((window , len(codes)) , np.nan)
+    low = np.full((window , len(codes)) , np.nan)
+    for j , code in enumerate(codes):
+        for matrix , key in ((close , 'close') , (high , 'high') , (low , 'low')):
+            tail = hists[ code ][ key ][ -window: ]
+            matrix[ window - len(tail): , j ] = tail
+    latest_close = close[ -1 ]
+
+    # 5日一块求和再两两相加，缺数据的块为 NaN，对应均线也为 NaN
+    sum5 = close[ 15:20 ].sum(axis = 0)
+    sum10 = sum5 + close[ 10:15 ].sum(axis = 0)
+    ma5 = sum5 / 5
+    ma10 = sum10 / 10
+    ma20 = (sum10 + (close[ 5:10 ].sum(axis = 0) +
+                     close[ 0:5 ].sum(axis = 0))) / 20
+
+    # 20日样本标准差，以最新收盘价为基准求偏差
+    diff = close - latest_close
+    total = diff.sum(axis = 0)
+    squares = (diff * diff).sum(axis = 0)
+    std20 = np.sqrt(np.maximum(squares - total * total / 20 , 0.0) / 19)
+
+    # 布林带位置得分
+    upper = ma20 + 2 * std20
+    lower = ma20 - 2 * std20
+    width = upper - lower
+    with np.errstate(invalid = 'ignore' , divide = 'ignore'):
+        bb_position = np.where(width > 0 , (latest_close - lower) / width , 0.5)
+    bb_score = np.select([ bb_position > 0.7 , bb_position > 0.3 ] , [ 30 , 70 ] , 40)
+
+    # 均线排列得分
+    ma_score = np.select([ (ma5 > ma10) & (ma10 > ma20) , ma5 > ma10 , ma5 > ma20 ] , [ 90 , 70 , 60 ] , 40)
+
+    # SAR指标（简化版）：最近5天的最高价和最低价，忽略补齐的 NaN
+    recent_high = np.fmax.reduce(high[ -5: ] , axis = 0)
+    recent_low = np.fmin.reduce(low[ -5: ] , axis = 0)
+    sar_score = np.select([ latest_close > recent_high , latest_close < recent_low ] , [ 80 , 30 ] , 60)
+
+    technical = bb_score * 0.3 + ma_score * 0.4 + sar_score * 0.3
+    scores.update(zip(codes , technical.tolist( )))
+    return scores
+
+
+# 东方财富日线接口，即 akshare 的 stock_zh_a_hist 所请求的地址
+EM_KLINE_URL = 'https://push2his.eastmoney.com/api/qt/stock/kline/get'
+
+
+async def _prefetch_hist(session , stock_code , start_date , end_date):
+    """
+    用 aiohttp 直接请求日线数据（不复权），转成 float64 数组后存入 _hist_arrays 的缓存
+    缓存里已有时不再请求；请求被拒绝或没有返回数据时不存，之后评分时按原来的方式请求
+    """
+    hit , _ = _hist_arrays.lookup(stock_code , start_date , end_date)
+    if hit:
+        return
+
+    params = {
+        'fields1': 'f1,f2,f3,f4,f5,f6' ,
+        'fields2': 'f51,f52,f53,f54,f55,f56' ,  # 日期、开盘、收盘、最高、最低、成交量
+        'ut': '7eea3edcaed734bea9cbfc24409ed989' ,
+        'klt': '101' ,  # 日线
+        'fqt': '0' ,  # 不复权
+        'secid': f"{1 if stock_code.startswith('6') else 0}.{stock_code}" ,
+        'beg': start_date ,
+        'end': end_date
+    }
+    async with session.get(EM_KLINE_URL , params = params) as response:
+        if response.status != 200:
+            return
+        data_json = await response.json(content_type = None)
+
+    # 限流或代码有误时 data 为 null
+    data = data_json.get('data')
+    if not data:
+        return
+
+    klines = data.get('klines') or [ ]
+    arrays = None
+    if klines:
+        # 每行为 日期,开盘,收盘,最高,最低,成交量，取后四列
+        rows = np.array([ line.split(',')[ 2:6 ] for line in klines ] , dtype = np.float64)
+        arrays = tuple(np.ascontiguousarray(column) for column in rows.T)
+    _hist_arrays.store(arrays , stock_code , start_date , end_date)
+
+
+async def _prefetch_async(stock_list , start_date , end_date):
+    """
+    在一个事件循环里并发预取整批股票的数据，存入各接口的缓存，之后的评分直接读缓存
+    日线数据用 aiohttp 直接请求；其余接口仍通过 akshare，放到线程里执行
+    出错的请求忽略，之后评分时会按原来的方式再请求一次
+    用到时才导入 aiohttp，没有安装时抛出 ImportError
+    """
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(limit = 50)
+    timeout = aiohttp.ClientTimeout(total = 30)
+    async with aiohttp.ClientSession(connector = connector , timeout = timeout) as session:
+        tasks = [ asyncio.to_thread(_stock_hsgt_hold_panel) , asyncio.to_thread(_stock_margin_panel) ]
+        for stock_code in stock_list:
+            tasks.append(_prefetch_hist(session , stock_code , start_date , end_date))
+            tasks.append(asyncio.to_thread(_stock_individual_fund_flow , stock_code))
+            tasks.append(asyncio.to_thread(_stock_individual_info_em , stock_code))
+        await asyncio.gather(*tasks , return_exceptions = True)
+
 
 class SmartMoneyScorer:
     """
@@ -18,6 +533,34 @@ class SmartMoneyScorer:
     从融资情况、北向资金、主力资金、技术指标等多维度评估股票
     """
 
+    # 多只股票分析结果的列，顺序与 calculate_comprehensive_score 返回的字典一致
+    RESULT_COLUMNS = ('funding_score' , 'north_money_score' , 'main_money_score' , 'technical_score' ,
+                      'price_volume_score' , 'market_performance_score' , 'liquidity_score' ,
+                      'total_score' , 'stock_code')
+
+    # 雷达图的维度名称和对应得分，末尾重复第一项使图形闭合
+    _RADAR_DIMS = ('融资情况' , '北向资金' , '主力资金' , '技术指标' ,
+                   '价量关系' , '市场表现' , '流通盘' , '融资情况')
+    _SCORE_KEYS = ('funding_score' , 'north_money_score' , 'main_money_score' , 'technical_score' ,
+                   'price_volume_score' , 'market_performance_score' , 'liquidity_score' , 'funding_score')
+    _RADAR_ANGLES = np.linspace(0 , 2 * np.pi , len(_RADAR_DIMS) , endpoint = True)
+
+    # 各维度的分段打分表，指标和阈值都用 float64
+    LADDERS = {
+        # 融资余额变化率
+        'funding_score': Ladder(np.array([ -0.05 , 0 , 0.05 , 0.1 ] , dtype = np.float64) ,
+                                np.array([ 20 , 40 , 60 , 75 , 90 ])) ,
+        # 北向资金持股变化率
+        'north_money_score': Ladder(np.array([ -0.1 , -0.05 , 0 , 0.05 , 0.1 , 0.2 ] , dtype = np.float64) ,
+                                    np.array([ 20 , 30 , 45 , 60 , 70 , 80 , 95 ])) ,
+        # 主力净流入，超1000万最高
+        'main_money_score': Ladder(np.array([ -5000000 , 0 , 5000000 , 10000000 ] , dtype = np.float64) ,
+                                   np.array([ 25 , 40 , 60 , 75 , 90 ])) ,
+        # 20日收益率
+        'market_performance_score': Ladder(np.array([ -0.1 , 0 , 0.1 , 0.2 ] , dtype = np.float64) ,
+                                           np.array([ 30 , 45 , 65 , 75 , 90 ]))
+    }
+
     def __init__(self):
         self.weights = {
             'funding_score': 0.15 ,  # 融资情况
@@ -29,26 +572,30 @@ class SmartMoneyScorer:
             'liquidity_score': 0.10  # 流通盘
         }
 
+        # 按当前的权重和分段表生成专用函数，常数直接写在函数里，每只股票打分时不再查字典和数组
+        self._weighted_total = make_weighted_sum(self.weights)
+        self._ladders = {dimension: make_ladder_function(ladder) for dimension , ladder in self.LADDERS.items( )}
+
     def get_stock_basic_info(self , stock_code):
         """获取股票基本信息"""
         try:
             # 使用akshare获取股票基本信息
-            stock_info = ak.stock_individual_info_em(symbol = stock_code)
+            stock_info = _stock_individual_info_em(stock_code)
             return stock_info
-        except:
+        except Exception:
             return None
 
-    def calculate_funding_score(self , stock_code):
+    def calculate_funding_score(self , stock_code , margin_panel = None):
         """计算融资情况得分:cite[5]:cite[9]"""
         try:
-            # 获取融资融券数据
-            margin_data = ak.stock_margin_sse(symbol = stock_code)
-            if margin_data.empty:
-                return 50
+            # 获取融资融券明细，批量分析时传入已取好的全市场数据
+            if margin_panel is None:
+                margin_panel = load_panel(_stock_margin_panel , '标的证券代码')
+            margin_data = margin_panel.loc[ stock_code ]
 
             # 计算融资余额变化率
-            latest_margin = margin_data.iloc[ 0 ][ 'rzjyye' ]  # 融资余额
-            prev_margin = margin_data.iloc[ 1 ][ 'rzjyye' ] if len(margin_data) > 1 else latest_margin
+            latest_margin = float(margin_data[ '融资余额' ])
+            prev_margin = float(margin_data[ '上一交易日融资余额' ])
 
             if prev_margin > 0:
                 margin_change = (latest_margin - prev_margin) / prev_margin
@@ -56,160 +603,72 @@ class SmartMoneyScorer:
                 margin_change = 0
 
             # 融资余额增长得分
-            if margin_change > 0.1:
-                margin_score = 90
-            elif margin_change > 0.05:
-                margin_score = 75
-            elif margin_change > 0:
-                margin_score = 60
-            elif margin_change > -0.05:
-                margin_score = 40
-            else:
-                margin_score = 20
-
-            return margin_score
-        except:
+            return self._ladders[ 'funding_score' ](margin_change)
+        except Exception:
             return 50
 
-    def calculate_north_money_score(self , stock_code):
+    def calculate_north_money_score(self , stock_code , north_panel = None):
         """计算北向资金得分:cite[1]"""
         try:
-            # 获取北向资金持股数据
-            north_data = ak.stock_hsgt_hold_stock_em(market = "北向" , symbol = stock_code)
-            if north_data.empty:
-                return 50
+            # 获取北向资金持股数据，批量分析时传入已取好的全市场数据
+            if north_panel is None:
+                north_panel = load_panel(_stock_hsgt_hold_panel , '代码')
+            north_data = north_panel.loc[ stock_code ]
 
-            # 计算持股比例变化
-            latest_hold = north_data.iloc[ 0 ][ '持股数量' ]
-            prev_hold = north_data.iloc[ 1 ][ '持股数量' ] if len(north_data) > 1 else latest_hold
+            # 计算持股变化：今日持股减去今日增持即为上一交易日持股
+            latest_hold = float(north_data[ '今日持股-股数' ])
+            increase = float(north_data[ '今日增持估计-股数' ])
+            prev_hold = latest_hold - increase
 
             if prev_hold > 0:
-                hold_change = (latest_hold - prev_hold) / prev_hold
+                hold_change = increase / prev_hold
             else:
                 hold_change = 0
 
             # 北向资金增持得分
-            if hold_change > 0.2:
-                north_score = 95
-            elif hold_change > 0.1:
-                north_score = 80
-            elif hold_change > 0.05:
-                north_score = 70
-            elif hold_change > 0:
-                north_score = 60
-            elif hold_change > -0.05:
-                north_score = 45
-            elif hold_change > -0.1:
-                north_score = 30
-            else:
-                north_score = 20
-
-            return north_score
-        except:
+            return self._ladders[ 'north_money_score' ](hold_change)
+        except Exception:
             return 50
 
     def calculate_main_money_score(self , stock_code):
         """计算主力资金得分:cite[9]"""
         try:
             # 获取主力资金流向数据
-            money_flow = ak.stock_individual_fund_flow(stock = stock_code , market = "主板")
+            money_flow = _stock_individual_fund_flow(stock_code)
             if money_flow.empty:
                 return 50
 
             # 计算主力净流入
-            main_net_inflow = money_flow.iloc[ 0 ][ '主力净流入' ]
-            turnover = money_flow.iloc[ 0 ][ '换手率' ]
+            main_net_inflow = money_flow[ '主力净流入' ].to_numpy(dtype = np.float64)[ 0 ]
+            turnover = money_flow[ '换手率' ].to_numpy(dtype = np.float64)[ 0 ]
 
             # 主力资金得分
-            if main_net_inflow > 10000000:  # 净流入超1000万
-                main_score = 90
-            elif main_net_inflow > 5000000:
-                main_score = 75
-            elif main_net_inflow > 0:
-                main_score = 60
-            elif main_net_inflow > -5000000:
-                main_score = 40
-            else:
-                main_score = 25
-
-            return main_score
-        except:
+            return self._ladders[ 'main_money_score' ](main_net_inflow)
+        except Exception:
             return 50
 
-    def calculate_technical_score(self , stock_code):
+    def calculate_technical_score(self , hist):
         """计算技术指标得分:cite[2]:cite[6]"""
         try:
-            # 获取历史价格数据
-            stock_data = ak.stock_zh_a_hist(symbol = stock_code , period = "daily" ,
-                                            start_date = (datetime.now( ) - timedelta(days = 60)).strftime('%Y%m%d') ,
-                                            end_date = datetime.now( ).strftime('%Y%m%d'))
-            if stock_data.empty:
+            if hist is None:
                 return 50
 
-            # 计算布林带
-            stock_data[ 'MA20' ] = stock_data[ '收盘' ].rolling(window = 20).mean( )
-            stock_data[ 'STD20' ] = stock_data[ '收盘' ].rolling(window = 20).std( )
-            stock_data[ 'Upper' ] = stock_data[ 'MA20' ] + 2 * stock_data[ 'STD20' ]
-            stock_data[ 'Lower' ] = stock_data[ 'MA20' ] - 2 * stock_data[ 'STD20' ]
-
-            latest_close = stock_data.iloc[ -1 ][ '收盘' ]
-            ma20 = stock_data.iloc[ -1 ][ 'MA20' ]
-            upper = stock_data.iloc[ -1 ][ 'Upper' ]
-            lower = stock_data.iloc[ -1 ][ 'Lower' ]
-
-            # 布林带位置得分:cite[2]
-            bb_position = (latest_close - lower) / (upper - lower) if (upper - lower) > 0 else 0.5
-
-            if bb_position > 0.7:
-                bb_score = 30  # 接近上轨，可能超买
-            elif bb_position > 0.3:
-                bb_score = 70  # 中轨附近
-            else:
-                bb_score = 40  # 接近下轨，可能超卖
-
-            # 均线排列得分
-            ma5 = stock_data[ '收盘' ].rolling(window = 5).mean( ).iloc[ -1 ]
-            ma10 = stock_data[ '收盘' ].rolling(window = 10).mean( ).iloc[ -1 ]
-
-            if ma5 > ma10 > ma20:
-                ma_score = 90
-            elif ma5 > ma10:
-                ma_score = 70
-            elif ma5 > ma20:
-                ma_score = 60
-            else:
-                ma_score = 40
-
-            # SAR指标（简化版）
-            recent_high = stock_data[ '最高' ].tail(5).max( )
-            recent_low = stock_data[ '最低' ].tail(5).min( )
-
-            if latest_close > recent_high:
-                sar_score = 80
-            elif latest_close < recent_low:
-                sar_score = 30
-            else:
-                sar_score = 60
-
-            technical_score = (bb_score * 0.3 + ma_score * 0.4 + sar_score * 0.3)
-            return technical_score
-        except:
+            return _get_technical_kernel( )(hist[ 'close' ] , hist[ 'high' ] , hist[ 'low' ])
+        except Exception:
             return 50
 
-    def calculate_price_volume_score(self , stock_code):
+    def calculate_price_volume_score(self , hist):
         """计算价量关系得分:cite[10]"""
         try:
-            stock_data = ak.stock_zh_a_hist(symbol = stock_code , period = "daily" ,
-                                            start_date = (datetime.now( ) - timedelta(days = 30)).strftime('%Y%m%d') ,
-                                            end_date = datetime.now( ).strftime('%Y%m%d'))
-            if stock_data.empty:
+            if hist is None:
                 return 50
 
+            close = hist[ 'close' ]
+            volume = hist[ 'volume' ]
+
             # 计算量价配合度
-            price_change = (stock_data.iloc[ -1 ][ '收盘' ] - stock_data.iloc[ -2 ][ '收盘' ]) / stock_data.iloc[ -2 ][
-                '收盘' ]
-            volume_change = (stock_data.iloc[ -1 ][ '成交量' ] - stock_data.iloc[ -2 ][ '成交量' ]) / \
-                            stock_data.iloc[ -2 ][ '成交量' ]
+            price_change = (close[ -1 ] - close[ -2 ]) / close[ -2 ]
+            volume_change = (volume[ -1 ] - volume[ -2 ]) / volume[ -2 ]
 
             # 价涨量增或价跌量缩为健康
             if (price_change > 0 and volume_change > 0) or (price_change < 0 and volume_change < 0):
@@ -220,46 +679,33 @@ class SmartMoneyScorer:
                 pv_score = 60
 
             return pv_score
-        except:
+        except Exception:
             return 50
 
-    def calculate_market_performance_score(self , stock_code):
+    def calculate_market_performance_score(self , hist):
         """计算市场表现得分"""
         try:
-            stock_data = ak.stock_zh_a_hist(symbol = stock_code , period = "daily" ,
-                                            start_date = (datetime.now( ) - timedelta(days = 60)).strftime('%Y%m%d') ,
-                                            end_date = datetime.now( ).strftime('%Y%m%d'))
-            if stock_data.empty:
+            if hist is None:
                 return 50
 
+            close = hist[ 'close' ]
+
             # 计算近期收益率
-            current_price = stock_data.iloc[ -1 ][ '收盘' ]
-            price_20_days_ago = stock_data.iloc[ -20 ][ '收盘' ] if len(stock_data) >= 20 else stock_data.iloc[ 0 ][
-                '收盘' ]
+            current_price = close[ -1 ]
+            price_20_days_ago = close[ -20 ] if len(close) >= 20 else close[ 0 ]
 
             return_20d = (current_price - price_20_days_ago) / price_20_days_ago
 
             # 收益率得分
-            if return_20d > 0.2:
-                performance_score = 90
-            elif return_20d > 0.1:
-                performance_score = 75
-            elif return_20d > 0:
-                performance_score = 65
-            elif return_20d > -0.1:
-                performance_score = 45
-            else:
-                performance_score = 30
-
-            return performance_score
-        except:
+            return self._ladders[ 'market_performance_score' ](return_20d)
+        except Exception:
             return 50
 
     def calculate_liquidity_score(self , stock_code):
         """计算流通盘得分:cite[9]"""
         try:
             # 获取流通市值信息
-            stock_info = ak.stock_individual_info_em(symbol = stock_code)
+            stock_info = _stock_individual_info_em(stock_code)
             if stock_info.empty:
                 return 50
 
@@ -277,81 +723,135 @@ class SmartMoneyScorer:
                 liquidity_score = 50  # 超大盘股，弹性小
 
             return liquidity_score
-        except:
+        except Exception:
             return 50
 
-    def calculate_comprehensive_score(self , stock_code):
-        """计算综合评分"""
-        scores = {}
-
-        scores[ 'funding_score' ] = self.calculate_funding_score(stock_code)
-        scores[ 'north_money_score' ] = self.calculate_north_money_score(stock_code)
-        scores[ 'main_money_score' ] = self.calculate_main_money_score(stock_code)
-        scores[ 'technical_score' ] = self.calculate_technical_score(stock_code)
-        scores[ 'price_volume_score' ] = self.calculate_price_volume_score(stock_code)
-        scores[ 'market_performance_score' ] = self.calculate_market_performance_score(stock_code)
-        scores[ 'liquidity_score' ] = self.calculate_liquidity_score(stock_code)
+    def calculate_comprehensive_score(self , stock_code , north_panel = None , margin_panel = None ,
+                                      hist = None , technical_score = None):
+        """
+        计算综合评分
+        north_panel / margin_panel 为 load_panel 取好的全市场北向持股、融资融券数据，不传则在评分函数里获取
+        hist / technical_score 为批量分析时已取好的日线数据和已算好的技术指标得分，可以只传其一，没传的在这里获取或计算
+        """
+        # 资金和流通盘各自访问不同的接口，并发请求以重叠网络等待
+        with ThreadPoolExecutor(max_workers = 4) as executor:
+            funding = executor.submit(self.calculate_funding_score , stock_code , margin_panel)
+            north_money = executor.submit(self.calculate_north_money_score , stock_code , north_panel)
+            main_money = executor.submit(self.calculate_main_money_score , stock_code)
+            liquidity = executor.submit(self.calculate_liquidity_score , stock_code)
+
+            if hist is None:
+                # 日期每只股票只算一次，所有日线请求用同一组日期，缓存键也保持一致
+                now = datetime.now( )
+                end_date = now.strftime('%Y%m%d')
+                start_date = (now - timedelta(days = 60)).strftime('%Y%m%d')
+
+                # 日线数据只下载一次，技术指标、价量关系、市场表现共用
+                hist = _fetch_hist(stock_code , start_date , end_date)
+            if technical_score is None:
+                technical_score = self.calculate_technical_score(hist)
+
+            scores = {
+                'funding_score': funding.result( ) ,
+                'north_money_score': north_money.result( ) ,
+                'main_money_score': main_money.result( ) ,
+                'technical_score': technical_score ,
+                'price_volume_score': self.calculate_price_volume_score(hist) ,
+                'market_performance_score': self.calculate_market_performance_score(hist) ,
+                'liquidity_score': liquidity.result( )
+            }
 
         # 计算加权总分
-        total_score = 0
-        for dimension , score in scores.items( ):
-            total_score += score * self.weights[ dimension ]
-
-        scores[ 'total_score' ] = total_score
+        scores[ 'total_score' ] = self._weighted_total(**scores)
         scores[ 'stock_code' ] = stock_code
 
         return scores
 
     def analyze_multiple_stocks(self , stock_list):
         """分析多只股票"""
-        results = [ ]
-        for stock in stock_list:
-            try:
-                score_result = self.calculate_comprehensive_score(stock)
-                results.append(score_result)
-                print(f"已完成 {stock} 的分析")
-            except Exception as e:
-                print(f"分析 {stock} 时出错: {str(e)}")
-                continue
-
-        # 转换为DataFrame并排序
-        df_results = pd.DataFrame(results)
-        df_results = df_results.sort_values('total_score' , ascending = False)
+        # 按列预先分配结果数组，第 i 只股票填第 i 行，最后一次生成 DataFrame
+        n = len(stock_list)
+        out = {column: np.empty(n , dtype = object if column == 'stock_code' else np.float64)
+               for column in self.RESULT_COLUMNS}
+        finished = np.zeros(n , dtype = bool)
+
+        # 整批股票的日线数据用同一组日期
+        now = datetime.now( )
+        end_date = now.strftime('%Y%m%d')
+        start_date = (now - timedelta(days = 60)).strftime('%Y%m%d')
+
+        # 装了 aiohttp 时先异步预取整批数据，下面的请求都直接读缓存
+        try:
+            asyncio.run(_prefetch_async(stock_list , start_date , end_date))
+        except ImportError:
+            pass  # 没有安装 aiohttp，不做异步预取，下面由线程池逐只请求
+        except RuntimeError:
+            pass  # 已在事件循环中运行（如 Jupyter），跳过预取，下面逐只请求
+
+        # 北向资金和融资融券取全市场数据，一次请求供所有股票使用
+        north_panel = load_panel(_stock_hsgt_hold_panel , '代码')
+        margin_panel = load_panel(_stock_margin_panel , '标的证券代码')
+
+        # 网络请求为主，多线程并发分析各只股票
+        with ThreadPoolExecutor(max_workers = 16) as executor:
+            # 先取回所有股票的日线数据，技术指标一次算完
+            hists = dict(zip(stock_list , executor.map(lambda stock: _fetch_hist(stock , start_date , end_date) ,
+                                                       stock_list)))
+            technical_scores = technical_scores_batch(hists)
+
+            futures = {executor.submit(self.calculate_comprehensive_score , stock , north_panel , margin_panel ,
+                                       hists[ stock ] , technical_scores[ stock ]): i
+                       for i , stock in enumerate(stock_list)}
+            for future in as_completed(futures):
+                i = futures[ future ]
+                stock = stock_list[ i ]
+                try:
+                    score_result = future.result( )
+                    for column in self.RESULT_COLUMNS:
+                        out[ column ][ i ] = score_result[ column ]
+                    finished[ i ] = True
+                    print(f"已完成 {stock} 的分析")
+                except Exception as e:
+                    print(f"分析 {stock} 时出错: {str(e)}")
+                    continue
+
+        # 去掉出错的股票，按综合得分从高到低排序后转换为DataFrame，得分相同的保持输入顺序
+        out = {column: values[ finished ] for column , values in out.items( )}
+        order = np.argsort(-out[ 'total_score' ] , kind = 'stable')
+        df_results = pd.DataFrame({column: values[ order ] for column , values in out.items( )})
 
         return df_results
 
     def generate_radar_chart(self , scores , stock_name):
         """生成雷达图"""
-        dimensions = [ '融资情况' , '北向资金' , '主力资金' , '技术指标' ,
-                       '价量关系' , '市场表现' , '流通盘' ]
+        # 只有画图时才导入 matplotlib；Linux 下没有图形界面时用 Agg 后端，把图保存成文件
+        import matplotlib
+        headless = sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or
+                                                             os.environ.get('WAYLAND_DISPLAY'))
+        if headless:
+            matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
 
-        values = [
-            scores[ 'funding_score' ] ,
-            scores[ 'north_money_score' ] ,
-            scores[ 'main_money_score' ] ,
-            scores[ 'technical_score' ] ,
-            scores[ 'price_volume_score' ] ,
-            scores[ 'market_performance_score' ] ,
-            scores[ 'liquidity_score' ]
-        ]
-
-        # 闭合雷达图
-        values.append(values[ 0 ])
-        dimensions.append(dimensions[ 0 ])
-
-        angles = np.linspace(0 , 2 * np.pi , len(dimensions) , endpoint = True)
+        values = [ scores[ key ] for key in self._SCORE_KEYS ]
+        angles = self._RADAR_ANGLES
 
         fig , ax = plt.subplots(figsize = (10 , 10) , subplot_kw = dict(projection = 'polar'))
         ax.plot(angles , values , 'o-' , linewidth = 2 , label = stock_name)
         ax.fill(angles , values , alpha = 0.25)
-        ax.set_thetagrids(angles[ :-1 ] * 180 / np.pi , dimensions[ :-1 ])
+        ax.set_thetagrids(angles[ :-1 ] * 180 / np.pi , self._RADAR_DIMS[ :-1 ])
         ax.set_ylim(0 , 100)
         ax.grid(True)
         plt.title(f'{stock_name} - 聪明资金综合评分雷达图\n综合得分: {scores[ "total_score" ]:.1f}' ,
                   size = 14 , pad = 20)
         plt.legend(loc = 'upper right' , bbox_to_anchor = (1.3 , 1.1))
         plt.tight_layout( )
-        plt.show( )
+        if headless:
+            file_name = f'{stock_name}_雷达图.png'
+            plt.savefig(file_name)
+            plt.close(fig)
+            print(f"雷达图已保存到 {file_name}")
+        else:
+            plt.show( )
 
     def generate_report(self , scores , stock_code):
         """生成详细报告"""